@@ -9,9 +9,19 @@ Usage:
 """
 
 import streamlit as st
-import pdfplumber
-import re
+import io
+import csv
+import os
+import threading
+import multiprocessing
+import numpy as np
 import pandas as pd
+import ahocorasick
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+import audit_engine
 
 # ==========================================
 # 1. PAGE CONFIGURATION
@@ -27,49 +37,244 @@ st.set_page_config(
 # 2. HELPER FUNCTIONS
 # ==========================================
 
-def extract_financials(text):
+# Audit statuses, from lowest to highest risk
+RISK_STATUSES = ["Approved", "Medium Risk", "High Risk"]
+
+# Watchlists up to this size are matched with plain str.find (CPython's C
+# substring search), which beats walking the automaton for a handful of names.
+# Larger watchlists use Aho-Corasick, whose cost doesn't grow with the list.
+_SUBSTRING_SEARCH_MAX_VENDORS = 8
+
+def _is_word_char(ch):
     """
-    Parses text to find all monetary values using Regex.
-    Returns a list of floats found in the document.
+    Mirrors Regex word characters for watchlist boundary checks.
     """
-    # Regex to capture various currency formats ($1,000.00, 500 USD, etc.)
-    dollar_pattern = r"(?:\$|USD)\s*([0-9]{1,3}(?:,[0-9]{3})*(?:\.[0-9]{2})?|[0-9]+(?:\.[0-9]{2})?)|([0-9]{1,3}(?:,[0-9]{3})*(?:\.[0-9]{2})?)\s*USD"
-    
-    amounts = []
-    matches = re.findall(dollar_pattern, text)
-    
-    for match in matches:
-        # Regex groups: match[0] is prefix ($), match[1] is suffix (USD)
-        val_str = match[0] if match[0] else match[1]
-        if val_str:
-            # Clean string to float
-            try:
-                clean_val = float(val_str.replace(",", ""))
-                amounts.append(clean_val)
-            except ValueError:
-                continue
-                
-    return amounts
+    return ch.isalnum() or ch == "_"
+
+def _is_whole_word(text, start, end):
+    """
+    Word Boundary Check ensures we don't match substrings like "Bad" in "Baden".
+    Checks that text[start:end] isn't flanked by word characters.
+    """
+    if start > 0 and _is_word_char(text[start - 1]):
+        return False
+    if end < len(text) and _is_word_char(text[end]):
+        return False
+    return True
+
+def _scan_with_substrings(needles, lowered, show_all_hits):
+    """
+    Small-watchlist matcher: one C-level substring search per
+    (lowercased name, name) needle.
+    Returns [(start, vendor)] for each vendor's first whole-word occurrence.
+    """
+    positions = []
+    for key, vendor in needles:
+        idx = lowered.find(key)
+        while idx != -1 and not _is_whole_word(lowered, idx, idx + len(key)):
+            idx = lowered.find(key, idx + 1)
+        if idx != -1:
+            positions.append((idx, vendor))
+            if not show_all_hits:
+                break
+    return positions
+
+def _scan_with_automaton(automaton, lowered, show_all_hits):
+    """
+    Large-watchlist matcher: a single Aho-Corasick pass over the text.
+    Returns [(start, vendor)] for each vendor's first whole-word occurrence.
+    """
+    positions = []
+    seen = set()
+    for end, (length, vendor) in automaton.iter(lowered):
+        start = end - length + 1
+        if vendor in seen or not _is_whole_word(lowered, start, end + 1):
+            continue
+        seen.add(vendor)
+        positions.append((start, vendor))
+        if not show_all_hits:
+            break
+    return positions
+
+def find_blacklisted_vendors(lowered, matcher, show_all_hits=True):
+    """
+    Scans already-lowercased text with the watchlist matcher
+    (see build_blacklist_matcher).
+    Returns the vendor names found, ordered by where each first appears.
+    With show_all_hits=False the scan stops at the first watchlisted vendor
+    it confirms and returns only that one, which is all that's needed to flag
+    the invoice as High Risk. That vendor isn't necessarily the earliest in the text.
+    """
+    return [vendor for _, vendor in sorted(matcher(lowered, show_all_hits))]
+
+@st.cache_resource(show_spinner=False)
+def build_blacklist_matcher(vendors):
+    """
+    Builds the watchlist matcher used by find_blacklisted_vendors: a callable
+    taking (lowered_text, show_all_hits).
+    Small watchlists are searched name by name with str.find; larger ones use
+    an Aho-Corasick automaton so every vendor is matched in a single
+    left-to-right pass, regardless of watchlist size.
+    Cached on the vendor tuple, so reruns that don't edit the watchlist reuse it.
+    Returns None for an empty watchlist.
+    """
+    if not vendors:
+        return None
+
+    if len(vendors) <= _SUBSTRING_SEARCH_MAX_VENDORS:
+        needles = {}
+        for v in vendors:
+            needles.setdefault(v.lower(), v)
+        return partial(_scan_with_substrings, list(needles.items()))
+
+    automaton = ahocorasick.Automaton()
+    for v in vendors:
+        key = v.lower()
+        if key not in automaton:
+            # Value keeps the needle length (to locate the match start) and the
+            # vendor name as the user typed it (for the audit log).
+            automaton.add_word(key, (len(key), v))
+    automaton.make_automaton()
+    return partial(_scan_with_automaton, automaton)
+
+@st.cache_resource(show_spinner=False)
+def get_process_pool():
+    """
+    Shared worker pool for PDF parsing, kept alive across reruns.
+    Workers are spawned, not forked: the pool starts from threads inside the
+    multithreaded Streamlit server, where a fork can inherit held locks and
+    deadlock. Spawned workers only need audit_engine.read_pdf, which they import.
+    """
+    return ProcessPoolExecutor(
+        max_workers=os.cpu_count() or 1,
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_process_pool_lock():
+    """
+    Serializes replacing the shared pool, since every session submits to it.
+    """
+    return threading.Lock()
+
+def restart_process_pool(broken_pool):
+    """
+    Swaps out a broken shared pool (e.g. a worker was killed for running out
+    of memory), so this and every other session can keep auditing.
+    Returns the pool to retry on.
+    """
+    with get_process_pool_lock():
+        # Another thread may already have replaced it
+        if get_process_pool() is broken_pool:
+            get_process_pool.clear()
+            broken_pool.shutdown(wait=False, cancel_futures=True)
+        return get_process_pool()
+
+# Bounded so the lowercased text of every upload isn't held for the server's lifetime
+@st.cache_data(show_spinner=False, max_entries=256, ttl=3600)
+def extract_text_and_amounts(file_bytes):
+    """
+    Cached wrapper around audit_engine.read_pdf, keyed on the file contents.
+    Reruns with identical uploads (e.g. after a threshold change) skip
+    PDF parsing entirely; only cache misses are sent to the process pool.
+    A broken pool is replaced and the file retried once; a second failure
+    is raised, so it is never cached.
+    """
+    pool = get_process_pool()
+    try:
+        return pool.submit(audit_engine.read_pdf, file_bytes).result()
+    except (BrokenProcessPool, RuntimeError):
+        # RuntimeError: another session shut this pool down while replacing it
+        return restart_process_pool(pool).submit(audit_engine.read_pdf, file_bytes).result()
+
+def build_audit_log(names, extractions, threshold, matcher, show_all_hits=True):
+    """
+    Scores every extracted document against the audit rules.
+    Only the per-document scans run in Python; results go straight into
+    column arrays, and the scoring arithmetic, status bucketing and issue
+    text are computed column-wise with NumPy/Pandas.
+    Returns the audit log as a DataFrame.
+    """
+    n_docs = len(extractions)
+    totals = np.empty(n_docs)
+    n_blacklist_hits = np.empty(n_docs, dtype=np.int32)
+    errors = []
+    vendor_reasons = []
+
+    for i, (lowered_text, amounts_found, error_msg) in enumerate(extractions):
+        # Heuristic: Largest dollar amount is likely the "Total"
+        totals[i] = max(amounts_found) if amounts_found else 0.0
+        errors.append(error_msg or "")
+        vendors = []
+        if matcher is not None:
+            vendors = find_blacklisted_vendors(lowered_text, matcher, show_all_hits)
+        n_blacklist_hits[i] = len(vendors)
+        vendor_reasons.append("".join(f"Vendor '{v}' found on Watchlist; " for v in vendors))
+
+    errors = pd.Series(errors, dtype=object)
+
+    # C. Risk Scoring Engine
+    # 1. Error Checks (+25 pts), 2. High Value Check (+50 pts), 3. Blacklist Check (+100 pts)
+    read_failed = (errors != "").to_numpy()
+    extraction_failed = read_failed | (totals == 0)
+    over_threshold = totals > threshold
+    risk_score = (
+        extraction_failed * 25 + over_threshold * 50 + n_blacklist_hits * 100
+    ).astype(np.int32)
+
+    # D. Status Determination
+    # 100+ must involve Blacklist; 1-99 is High Value or extraction issues
+    status_codes = (risk_score > 0).astype(np.int8) + (risk_score >= 100)
+    status = pd.Categorical.from_codes(status_codes, categories=RISK_STATUSES)
+
+    # Each reason ends in "; " so the parts can be concatenated and trimmed once
+    error_reason = np.where(
+        read_failed, "⚠️ " + errors + "; ", "Extraction Failed: No dollar amounts detected; "
+    )
+    amount_reason = "Amount ($" + pd.Series(totals).map("{:,.2f}".format) + ") exceeds threshold; "
+    issues = (
+        pd.Series(np.where(extraction_failed, error_reason, ""), dtype=object)
+        + amount_reason.where(over_threshold, "")
+        + pd.Series(vendor_reasons, dtype=object)
+    ).str.removesuffix("; ")
+
+    # E. Log Result
+    return pd.DataFrame({
+        "Filename": names,
+        "Total Amount": totals,
+        "Status": status,
+        "Risk Score": risk_score,
+        "Issues": issues,
+    })
 
 def convert_df_to_csv(df):
     """
     Converts the audit log DataFrame into a CSV byte string for download.
+    Rows are streamed straight to csv.writer, skipping Pandas' per-cell formatter.
     """
-    return df.to_csv(index=False).encode('utf-8')
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(df.columns)
+    writer.writerows(df.itertuples(index=False, name=None))
+    return buffer.getvalue().encode('utf-8')
 
-def highlight_risk_rows(row):
+def highlight_risk_rows(df):
     """
     Pandas Styler function to color-code rows based on risk status.
     High Risk = Red, Medium = Yellow, Approved = Green.
+    Applied with axis=None, so the whole CSS grid is built in one call.
     """
     base_style = 'font-weight: bold; color: black; '
+    row_colors = {
+        'High Risk': '#ffcccc',
+        'Medium Risk': '#fff3cd',
+        'Approved': '#d4edda',
+    }
     
-    if row['Status'] == 'High Risk':
-        return [base_style + 'background-color: #ffcccc'] * len(row)
-    elif row['Status'] == 'Medium Risk':
-        return [base_style + 'background-color: #fff3cd'] * len(row)
-    else:
-        return [base_style + 'background-color: #d4edda'] * len(row)
+    row_css = base_style + 'background-color: ' + (
+        df['Status'].astype(str).map(row_colors).fillna(row_colors['Approved'])
+    )
+    return pd.DataFrame({col: row_css for col in df.columns}, index=df.index)
 
 # ==========================================
 # 3. SIDEBAR CONFIGURATION
@@ -101,6 +306,16 @@ vendor_blacklist_raw = st.sidebar.text_area(
 # Process Blacklist into a clean list
 vendor_blacklist = [v.strip() for v in vendor_blacklist_raw.split('\n') if v.strip()]
 
+# Watchlist matcher (cached, so only edits rebuild it)
+blacklist_matcher = build_blacklist_matcher(tuple(vendor_blacklist))
+
+show_all_hits = st.sidebar.checkbox(
+    "Report every watchlist match",
+    value=True,
+    help="Untick to stop scanning an invoice at its first watchlisted vendor. "
+         "Flagging is unchanged, but only one vendor (+100) is reported per invoice."
+)
+
 # Legend
 st.sidebar.markdown("---")
 st.sidebar.subheader("ℹ️ Risk Score Key")
@@ -131,91 +346,42 @@ uploaded_files = st.file_uploader(
 # ==========================================
 
 if uploaded_files:
-    # Initialize Master List for the CSV
-    master_audit_log = []
-    
-    # Dashboard Metrics
-    total_processed = 0
-    high_risk_count = 0
-    total_value_audited = 0.0
-
     st.write("---")
     st.subheader(f"📂 Processing {len(uploaded_files)} Documents...")
     
     progress_bar = st.progress(0)
 
     # --- Document Loop ---
-    for i, file in enumerate(uploaded_files):
-        extracted_text = ""
-        error_msg = None
-        
-        # A. Text Extraction (PDFPlumber)
-        try:
-            with pdfplumber.open(file) as pdf:
-                for page in pdf.pages:
-                    text = page.extract_text()
-                    if text:
-                        extracted_text += text
-        except Exception as e:
-            error_msg = f"Error reading PDF: {str(e)}"
-            extracted_text = ""
-
-        # B. Financial Data Extraction
-        amounts_found = []
-        if not error_msg:
-            amounts_found = extract_financials(extracted_text)
+    # Uploads are read as they're submitted, so later files are still being
+    # buffered while earlier ones are already parsing. Threads only wait on the
+    # cache or the process pool; two per core keeps every worker busy.
+    extractions = [None] * len(uploaded_files)
+    max_threads = min(len(uploaded_files), 2 * (os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
+        futures = {
+            executor.submit(extract_text_and_amounts, file.getvalue()): i
+            for i, file in enumerate(uploaded_files)
+        }
+        for done, future in enumerate(as_completed(futures)):
+            # Slot results back by upload order, whatever order they finish in
+            try:
+                extractions[futures[future]] = future.result()
+            except Exception as e:
+                # Pool failures are reported on the file, like an unreadable PDF
+                extractions[futures[future]] = ("", [], f"Error reading PDF: {str(e)}")
+            
+            # Update Progress Bar
+            progress_bar.progress((done + 1) / len(uploaded_files))
 
-        # Heuristic: Largest dollar amount is likely the "Total"
-        total_amount = max(amounts_found) if amounts_found else 0.0
-        total_value_audited += total_amount
-        
-        # C. Risk Scoring Engine
-        risk_score = 0
-        reasons = []
-        
-        # 1. Error Checks (+25 pts)
-        if error_msg:
-            risk_score += 25
-            reasons.append(f"⚠️ {error_msg}")
-        elif total_amount == 0:
-            risk_score += 25
-            reasons.append("Extraction Failed: No dollar amounts detected")
-
-        # 2. High Value Check (+50 pts)
-        if total_amount > audit_threshold:
-            risk_score += 50
-            reasons.append(f"Amount (${total_amount:,.2f}) exceeds threshold")
-        
-        # 3. Blacklist Check (+100 pts)
-        for bad_vendor in vendor_blacklist:
-            # Word Boundary Check (\b) ensures we don't match substrings like "Bad" in "Baden"
-            pattern = r"\b" + re.escape(bad_vendor) + r"\b"
-            if re.search(pattern, extracted_text, re.IGNORECASE):
-                risk_score += 100
-                reasons.append(f"Vendor '{bad_vendor}' found on Watchlist")
-
-        # D. Status Determination
-        if risk_score >= 100:
-            status = "High Risk"  # Must involve Blacklist
-            high_risk_count += 1
-        elif risk_score >= 50:
-            status = "Medium Risk" # High Value or errors
-        elif risk_score > 0:
-            status = "Medium Risk" # Minor extraction issues
-        else:
-            status = "Approved"
-
-        # E. Log Result
-        master_audit_log.append({
-            "Filename": file.name,
-            "Total Amount": total_amount,
-            "Status": status,
-            "Risk Score": risk_score,
-            "Issues": "; ".join(reasons)
-        })
-        
-        # Update Progress Bar
-        progress_bar.progress((i + 1) / len(uploaded_files))
+    # Scoring depends on the sidebar settings, so it always runs outside the cache
+    df = build_audit_log(
+        [file.name for file in uploaded_files], extractions,
+        audit_threshold, blacklist_matcher, show_all_hits
+    )
+
+    # Dashboard Metrics
+    total_value_audited = float(df["Total Amount"].sum())
+    high_risk_count = int((df["Status"] == "High Risk").sum())
 
     # ==========================================
     # 6. RESULTS DASHBOARD
@@ -231,11 +397,9 @@ if uploaded_files:
     # Detailed Table
     st.subheader("📊 Detailed Audit Log")
     
-    if master_audit_log:
-        df = pd.DataFrame(master_audit_log)
-        
+    if not df.empty:
         # Apply Conditional Formatting (Red/Yellow/Green)
-        st.dataframe(df.style.apply(highlight_risk_rows, axis=1), use_container_width=True)
+        st.dataframe(df.style.apply(highlight_risk_rows, axis=None), use_container_width=True)
 
         # Download Button
         csv_data = convert_df_to_csv(df)
@@ -0,0 +1,101 @@
+"""
+Auto-Audit Pro: Extraction Engine
+---------------------------------
+PDF text and dollar-amount extraction for the audit app.
+
+Kept out of the Streamlit script so worker processes can import it by name:
+Streamlit re-executes app.py as a fresh fake __main__ on every run, so
+functions defined there can't be reliably pickled to a process pool.
+"""
+
+import pdfplumber
+import re
+import io
+
+# Currency amounts: either comma-grouped (needs at least one ",ddd" group) or a
+# plain digit run, with optional cents. The two forms can't overlap, so a long
+# digit run is never re-split between them.
+_AMOUNT_PATTERN = r"(?:[0-9]{1,3}(?:,[0-9]{3})+|[0-9]+)(?:\.[0-9]{2})?"
+
+# Anchored matchers used by the scanner once a "$" / "USD" marker is located
+_PREFIX_AMOUNT_RE = re.compile(r"\s*(" + _AMOUNT_PATTERN + r")")
+_SUFFIX_AMOUNT_RE = re.compile(r"(?<![0-9])(" + _AMOUNT_PATTERN + r")\s*\Z")
+_AMOUNT_CHARS = frozenset("0123456789,.")
+
+def iter_page_text(pdf):
+    """
+    Yields the plain text of each page in an open pdfplumber document.
+    Each page's parsed objects are released as soon as its text is read,
+    so long documents don't keep every page's layout in memory.
+    """
+    for page in pdf.pages:
+        text = page.extract_text()
+        page.close()
+        if text:
+            yield text
+
+def extract_financials(text):
+    """
+    Parses text to find all monetary values ($1,000.00, 500 USD, USD 500).
+    Jumps between "$" and "USD" markers with str.find and only runs a short
+    anchored match at each one, instead of trying a regex at every character.
+    Returns a list of floats found in the document.
+    """
+    amounts = []
+    consumed = 0  # Text before this index already belongs to a matched amount
+    dollar = text.find("$")
+    usd = text.find("USD")
+
+    while dollar != -1 or usd != -1:
+        if usd == -1 or (dollar != -1 and dollar < usd):
+            # Prefix form: "$1,000.00"
+            if dollar >= consumed:
+                match = _PREFIX_AMOUNT_RE.match(text, dollar + 1)
+                if match:
+                    amounts.append(float(match.group(1).replace(",", "")))
+                    consumed = match.end()
+            dollar = text.find("$", dollar + 1)
+            continue
+
+        # Suffix form: "500 USD" takes priority over "USD 500", since a
+        # left-to-right scan reaches the number before the marker.
+        start = usd
+        while start > consumed and text[start - 1].isspace():
+            start -= 1
+        while start > consumed and text[start - 1] in _AMOUNT_CHARS:
+            start -= 1
+        match = _SUFFIX_AMOUNT_RE.search(text, start, usd)
+        if match:
+            consumed = usd + 3
+        elif usd >= consumed:
+            # Prefix form: "USD 500"
+            match = _PREFIX_AMOUNT_RE.match(text, usd + 3)
+            if match:
+                consumed = match.end()
+        if match:
+            amounts.append(float(match.group(1).replace(",", "")))
+        usd = text.find("USD", usd + 3)
+
+    return amounts
+
+def read_pdf(file_bytes):
+    """
+    Extracts the text and dollar amounts from one PDF.
+    Takes raw bytes so it can run in a worker process.
+    Returns (lowered_text, amounts, error_msg); error_msg is None on success.
+    The text comes back lowercased so the case-insensitive watchlist scan
+    never has to fold it again, even when the settings change on a rerun.
+    """
+    # A. Text Extraction (PDFPlumber)
+    try:
+        with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
+            # Newline keeps the last word of a page from running into the next page
+            extracted_text = "\n".join(iter_page_text(pdf))
+    except Exception as e:
+        return "", [], f"Error reading PDF: {str(e)}"
+
+    # B. Financial Data Extraction ("USD" markers are case-sensitive, so this runs first)
+    # Runs on the joined text so an amount and its marker can straddle a page break.
+    amounts_found = extract_financials(extracted_text)
+
+    return extracted_text.lower(), amounts_found, None